@@ -26,21 +26,19 @@ def get_utility_statistics(utility):
 
 
 def get_utilities(ast):
-    def get_utilities_fun(node):
-        utilities = set([])
+    utilities = set([])
+    if not ast:
+        return utilities
+    # iterative DFS; argument subtrees are not searched
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if node.is_argument():
+            continue
         if node.is_utility():
             utilities.add(node.value)
-            for child in node.children:
-                utilities = utilities.union(get_utilities_fun(child))
-        elif not node.is_argument():
-            for child in node.children:
-                utilities = utilities.union(get_utilities_fun(child))
-        return utilities
-
-    if not ast:
-        return set([])
-    else:
-        return get_utilities_fun(ast)
+        stack.extend(node.children)
+    return utilities
 
 
 def bash_tokenizer(cmd, recover_quotation=True, loose_constraints=False,
@@ -145,8 +143,9 @@ def ast2tokens(node, loose_constraints=False, ignore_flag_order=False,
                 tokens += to_tokens_fun(child)
         elif node.is_option():
             assert(loose_constraints or node.parent)
-            if '::' in node.value and (node.value.startswith('-exec') or 
-                                       node.value.startswith('-ok')):
+            is_exec = '::' in node.value and \
+                node.value.startswith(('-exec', '-ok'))
+            if is_exec:
                 value, op = node.value.split('::')
                 token = value
             else:
@@ -170,8 +169,7 @@ def ast2tokens(node, loose_constraints=False, ignore_flag_order=False,
             tokens.append(token)
             for child in node.children:
                 tokens += to_tokens_fun(child)
-            if '::' in node.value and (node.value.startswith('-exec') or
-                                       node.value.startswith('-ok')):
+            if is_exec:
                 if op == ';':
                     op = "\\;"
                 tokens.append(op)
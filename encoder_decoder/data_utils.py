@@ -8,6 +8,8 @@ from __future__ import print_function
 
 import collections
 import functools
+import itertools
+import multiprocessing
 import os
 import pickle
 import sys
@@ -92,6 +94,8 @@ CHAR_INIT_VOCAB = [
     _CGO
 ]
 
+ALL_INIT_VOCAB = set(TOKEN_INIT_VOCAB + CHAR_INIT_VOCAB)
+
 data_splits = ['train', 'dev', 'test']
 TOKEN_SEPARATOR = '<TOKEN_SEPARATOR>'
 
@@ -122,6 +126,7 @@ class Vocab(object):
         self.tg_vocab = None
         self.rev_sc_vocab = None
         self.rev_tg_vocab = None
+        self.clean_rev_tg_vocab = None
         self.max_sc_token_size = -1
         self.max_tg_token_size = -1
 
@@ -152,23 +157,12 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
         return os.path.join(data_dir, '{}.{}.{}'.format(split, lang, channel))
 
     def get_source_ids(s):
-        source_ids = []
-        for token in s.split(TOKEN_SEPARATOR):
-            if token in vocab.sc_vocab:
-                source_ids.append(vocab.sc_vocab[token])
-            else:
-                source_ids.append(UNK_ID)
-        return source_ids
+        return tokens_to_ids(s.split(TOKEN_SEPARATOR), vocab.sc_vocab)
 
     def get_target_input_ids(s):
-        target_ids = []
-        for token in s.split(TOKEN_SEPARATOR):
-            if token in vocab.tg_vocab:
-                target_ids.append(vocab.tg_vocab[token])
-            else:
-                target_ids.append(UNK_ID)
+        target_ids = tokens_to_ids(s.split(TOKEN_SEPARATOR), vocab.tg_vocab)
         if add_start_token:
-            target_ids.insert(0, ROOT_ID)
+            target_ids = [ROOT_ID] + target_ids
         if add_end_token:
             target_ids.append(EOS_ID)
         return target_ids
@@ -201,17 +195,16 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
     max_sc_length = 0
     max_tg_length = 0
 
-    for i, sc_txt in enumerate(sc_file.readlines()):
+    for i, (sc_txt, tg_txt) in enumerate(zip(sc_file, tg_file)):
         data_point = DataPoint()
         data_point.sc_txt = sc_txt.strip()
-        data_point.tg_txt = tg_file.readline().strip()
+        data_point.tg_txt = tg_txt.strip()
         if load_features:
-            data_point.sc_ids = \
-                get_source_ids(sc_token_file.readline().strip())
+            data_point.sc_ids = get_source_ids(next(sc_token_file).strip())
             if len(data_point.sc_ids) > max_sc_length:
                 max_sc_length = len(data_point.sc_ids)
             data_point.tg_ids = \
-                get_target_input_ids(tg_token_file.readline().strip())
+                get_target_input_ids(next(tg_token_file).strip())
             data_point.alignments = alignments[i]
             if len(data_point.tg_ids) > max_tg_length:
                 max_tg_length = len(data_point.tg_ids)
@@ -239,13 +232,13 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
             tg_token_file = open(tg_token_path, encoding='utf-8')
             sc_copy_token_file = open(sc_copy_token_path, encoding='utf-8')
             tg_copy_token_file = open(tg_copy_token_path, encoding='utf-8')
-            for i, data_point in enumerate(dataset):
-                sc_tokens = sc_token_file.readline().strip().split(TOKEN_SEPARATOR)
-                tg_tokens = tg_token_file.readline().strip().split(TOKEN_SEPARATOR)
-                sc_copy_tokens = \
-                    sc_copy_token_file.readline().strip().split(TOKEN_SEPARATOR)
-                tg_copy_tokens = \
-                    tg_copy_token_file.readline().strip().split(TOKEN_SEPARATOR)
+            for data_point, sc_line, tg_line, sc_copy_line, tg_copy_line in \
+                    zip(dataset, sc_token_file, tg_token_file,
+                        sc_copy_token_file, tg_copy_token_file):
+                sc_tokens = sc_line.strip().split(TOKEN_SEPARATOR)
+                tg_tokens = tg_line.strip().split(TOKEN_SEPARATOR)
+                sc_copy_tokens = sc_copy_line.strip().split(TOKEN_SEPARATOR)
+                tg_copy_tokens = tg_copy_line.strip().split(TOKEN_SEPARATOR)
                 data_point.csc_ids, data_point.ctg_ids = \
                     compute_copy_indices(sc_tokens, tg_tokens,
                         sc_copy_tokens, tg_copy_tokens, vocab.tg_vocab, token_ext)
@@ -290,14 +283,16 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
             assert(num_buckets >= 1)
 
         dataset2 = [[] for _ in buckets]
-        for i in range(len(dataset)):
-            data_point = dataset[i]
-            # Compute bucket id
-            bucket_ids = [b for b in xrange(len(buckets))
-                          if buckets[b][0] > len(data_point.sc_ids) and
-                          buckets[b][1] > len(data_point.tg_ids)]
-            if bucket_ids:
-                bucket_id = min(bucket_ids)
+        # Compute bucket ids: the first bucket that fits both sequences
+        bucket_sizes = np.array(buckets)
+        sc_lengths = np.array([len(dp.sc_ids) for dp in dataset])
+        tg_lengths = np.array([len(dp.tg_ids) for dp in dataset])
+        fits = (bucket_sizes[:, 0] > sc_lengths[:, None]) & \
+               (bucket_sizes[:, 1] > tg_lengths[:, None])
+        bucket_ids = np.where(np.any(fits, axis=1), np.argmax(fits, axis=1),
+                              len(buckets))
+        for data_point, bucket_id in zip(dataset, bucket_ids):
+            if bucket_id < len(buckets):
                 dataset2[bucket_id].append(data_point)
             else:
                 if split != 'train':
@@ -305,7 +300,7 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
                     dataset2[bucket_id].append(data_point)
         dataset = dataset2
         if split != 'train':
-            assert(len(functools.reduce(lambda x, y: x + y, dataset)) == data_size)
+            assert(sum(len(bucket) for bucket in dataset) == data_size)
       
     D = DataSet()
     D.data_points = dataset
@@ -319,21 +314,36 @@ def read_data(FLAGS, split, source, target, use_buckets=True, buckets=None,
 
 
 def load_vocabulary(FLAGS):
-    data_dir = FLAGS.data_dir
-    source, target = ('nl', 'cm') if not FLAGS.explain else ('cm', 'nl')
-    token_ext = 'normalized.{}'.format(FLAGS.channel) \
-        if FLAGS.normalized else FLAGS.channel
+    min_vocab_frequency = 1 if FLAGS.channel == 'char' else FLAGS.min_vocab_frequency
+    return load_vocabulary_files(FLAGS.data_dir, FLAGS.explain, FLAGS.channel,
+                                 FLAGS.normalized, min_vocab_frequency)
+
+
+@functools.lru_cache(maxsize=4)
+def load_vocabulary_files(data_dir, explain, channel, normalized,
+                          min_vocab_frequency):
+    """
+    Load the source and target vocabularies of a dataset.
+
+    The result is cached since data loading, training and decoding each ask
+    for the same vocabularies; the returned object is shared between callers.
+    """
+    source, target = ('nl', 'cm') if not explain else ('cm', 'nl')
+    token_ext = 'normalized.{}'.format(channel) if normalized else channel
     vocab_ext = 'vocab.{}'.format(token_ext)
 
     source_vocab_path = os.path.join(data_dir, '{}.{}'.format(source, vocab_ext))
     target_vocab_path = os.path.join(data_dir, '{}.{}'.format(target, vocab_ext))
 
     vocab = Vocab()
-    min_vocab_frequency = 1 if FLAGS.channel == 'char' else FLAGS.min_vocab_frequency
     vocab.sc_vocab, vocab.rev_sc_vocab = initialize_vocabulary(
         source_vocab_path, min_vocab_frequency)
     vocab.tg_vocab, vocab.rev_tg_vocab = initialize_vocabulary(
         target_vocab_path, min_vocab_frequency)
+    # target tokens with the flag suffixes removed, as output by the decoder
+    vocab.clean_rev_tg_vocab = {
+        i: v.split(data_tools.flag_suffix)[0]
+        for i, v in vocab.rev_tg_vocab.items()}
 
     max_sc_token_size = 0
     for v in vocab.sc_vocab:
@@ -375,23 +385,20 @@ def initialize_vocabulary(vocab_path, min_frequency=1):
       ValueError: if the provided vocab_path does not exist.
     """
     if tf.io.gfile.exists(vocab_path):
-        V = []
+        vocab, rev_vocab = {}, {}
         with tf.io.gfile.GFile(vocab_path, mode="r") as f:
-            while(True):
-                line = f.readline()
-                if line:
-                    if line.startswith('\t'):
-                        v = line[0]
-                        freq = line.strip()   
-                    else:
-                        v, freq = line[:-1].rsplit('\t', 1)
-                    if int(freq) >= min_frequency \
-                            or data_tools.flag_suffix in v:
-                        V.append(v)
+            for line in f:
+                if line.startswith('\t'):
+                    v = line[0]
+                    freq = line.strip()   
                 else:
-                    break
-        vocab = dict([(x, y) for (y, x) in enumerate(V)])
-        rev_vocab = dict([(y, x) for (y, x) in enumerate(V)])
+                    v, freq = line[:-1].rsplit('\t', 1)
+                if int(freq) >= min_frequency \
+                        or data_tools.flag_suffix in v:
+                    v = sys.intern(v)
+                    idx = len(rev_vocab)
+                    vocab[v] = idx
+                    rev_vocab[idx] = v
         assert(len(vocab) == len(rev_vocab))
         return vocab, rev_vocab
     else:
@@ -446,20 +453,24 @@ def prepare_data(FLAGS):
     channel = FLAGS.channel if FLAGS.channel else ''
     if channel and FLAGS.normalized:
         channel = 'normalized.{}'.format(channel)
-    prepare_dataset_split(data_dir, 'train', channel=channel)
-    prepare_dataset_split(data_dir, 'dev', channel=channel)
-    prepare_dataset_split(data_dir, 'test', channel=channel)
+    # one worker pool is shared by all splits and channels
+    with multiprocessing.Pool() as pool:
+        prepare_dataset_split(data_dir, 'train', pool, channel=channel)
+        prepare_dataset_split(data_dir, 'dev', pool, channel=channel)
+        prepare_dataset_split(data_dir, 'test', pool, channel=channel)
 
 
-def prepare_dataset_split(data_dir, split, channel=''):
+def prepare_dataset_split(data_dir, split, pool, channel=''):
     """
     Process a specific dataset split.
+
+    :param pool: multiprocessing pool used to tokenize the examples.
     """
     def read_parallel_data(nl_path, cm_path):
         with open(nl_path, encoding='utf-8') as f:
-            nl_list = [nl.strip() for nl in f.readlines()]
+            nl_list = [nl.strip() for nl in f]
         with open(cm_path, encoding='utf-8') as f:
-            cm_list = [cm.strip() for cm in f.readlines()]
+            cm_list = [cm.strip() for cm in f]
         return nl_list, cm_list
 
     print("Split - {}".format(split))
@@ -469,28 +480,30 @@ def prepare_dataset_split(data_dir, split, channel=''):
 
     # character based processing
     if not channel or channel == 'char':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='char',
+        prepare_channel(data_dir, nl_list, cm_list, split, pool, channel='char',
                         parallel_data_to_tokens=parallel_data_to_characters)
     # partial-token based processing
     if not channel or channel == 'partial.token':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='partial.token',
+        prepare_channel(data_dir, nl_list, cm_list, split, pool,
+                        channel='partial.token',
                         parallel_data_to_tokens=parallel_data_to_partial_tokens)
     # token based processing
     if not channel or channel == 'token':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='token',
+        prepare_channel(data_dir, nl_list, cm_list, split, pool, channel='token',
                         parallel_data_to_tokens=parallel_data_to_tokens)
     # normalized token based processing
     if not channel or channel == 'normalized.token':
-        prepare_channel(data_dir, nl_list, cm_list, split, channel='normalized.token',
+        prepare_channel(data_dir, nl_list, cm_list, split, pool,
+                        channel='normalized.token',
                         parallel_data_to_tokens=parallel_data_to_normalized_tokens)
 
 
-def prepare_channel(data_dir, nl_list, cm_list, split, channel,
+def prepare_channel(data_dir, nl_list, cm_list, split, pool, channel,
                     parallel_data_to_tokens):
     print("    channel - {}".format(channel))
     # Tokenize data
     nl_tokens, cm_tokens = \
-        parallel_data_to_tokens(nl_list, cm_list)
+        parallel_data_to_tokens(nl_list, cm_list, pool)
     save_channel_features_to_file(data_dir, split, channel, nl_tokens, cm_tokens,
                                   feature_separator=TOKEN_SEPARATOR)
     # Create or load vocabulary
@@ -499,7 +512,7 @@ def prepare_channel(data_dir, nl_list, cm_list, split, channel,
     nl_vocab = create_vocabulary(nl_vocab_path, nl_tokens) \
         if split == 'train' else initialize_vocabulary(nl_vocab_path)[0]
     cm_vocab = create_vocabulary(cm_vocab_path, cm_tokens) \
-        if split == 'train' else initialize_vocabulary(cm_vocab_path)
+        if split == 'train' else initialize_vocabulary(cm_vocab_path)[0]
     nl_ids = [tokens_to_ids(data_point, nl_vocab) for data_point in nl_tokens]
     cm_ids = [tokens_to_ids(data_point, cm_vocab) for data_point in cm_tokens]
     save_channel_features_to_file(data_dir, split, 'ids.{}'.format(channel),
@@ -508,12 +521,11 @@ def prepare_channel(data_dir, nl_list, cm_list, split, channel,
     if channel == 'char':
         nl_copy_tokens, cm_copy_tokens = nl_tokens, cm_tokens
     else:
-        if channel == 'partial.token':
-            nl_copy_tokens = [nl_to_partial_tokens(nl, tokenizer.basic_tokenizer,
-                to_lower_case=False, lemmatization=False) for nl in nl_list]
-        else:
-            nl_copy_tokens = [nl_to_tokens(nl, tokenizer.basic_tokenizer,
-                to_lower_case=False, lemmatization=False) for nl in nl_list]
+        nl_to_copy_tokens = nl_to_partial_tokens \
+            if channel == 'partial.token' else nl_to_tokens
+        nl_copy_tokens = map_unique(pool, functools.partial(nl_to_copy_tokens,
+            tokenizer=tokenizer.basic_tokenizer, to_lower_case=False,
+            lemmatization=False), nl_list)
         cm_copy_tokens = cm_tokens
     save_channel_features_to_file(data_dir, split, 'copy.{}'.format(channel),
         nl_copy_tokens, cm_copy_tokens, feature_separator=TOKEN_SEPARATOR)
@@ -526,69 +538,80 @@ def prepare_channel(data_dir, nl_list, cm_list, split, channel,
 def save_channel_features_to_file(data_dir, split, channel, nl_features,
                                   cm_features, feature_separator):
     convert_to_str = channel.startswith('ids')
+
+    def feature_line(data_point):
+        if convert_to_str:
+            data_point = map(str, data_point)
+        return feature_separator.join(data_point) + '\n'
+
     nl_feature_path = os.path.join(data_dir, '{}.nl.{}'.format(split, channel))
     cm_feature_path = os.path.join(data_dir, '{}.cm.{}'.format(split, channel))
     with open(nl_feature_path, 'w', encoding='utf-8') as o_f:
-        for data_point in nl_features:
-            if convert_to_str:
-                o_f.write('{}\n'.format(feature_separator.join(
-                    [str(x) for x in data_point])))
-            else:
-                o_f.write('{}\n'.format(feature_separator.join(data_point)))
+        o_f.writelines(feature_line(data_point) for data_point in nl_features)
     with open(cm_feature_path, 'w', encoding='utf-8') as o_f:
-        for data_point in cm_features:
-            if convert_to_str:
-                o_f.write('{}\n'.format(feature_separator.join(
-                    [str(x) for x in data_point])))
-            else:
-                o_f.write('{}\n'.format(feature_separator.join(data_point)))
+        o_f.writelines(feature_line(data_point) for data_point in cm_features)
 
 
-def parallel_data_to_characters(nl_list, cm_list):
+def parallel_data_to_characters(nl_list, cm_list, pool):
     nl_data = [nl_to_characters(nl) for nl in nl_list]
     cm_data = [cm_to_characters(cm) for cm in cm_list]
     return nl_data, cm_data
 
 
-def parallel_data_to_partial_tokens(nl_list, cm_list):
-    nl_data = [nl_to_partial_tokens(nl, tokenizer.basic_tokenizer) for nl in nl_list]
-    cm_data = [cm_to_partial_tokens(cm, data_tools.bash_tokenizer) for cm in cm_list]
-    return nl_data, cm_data
+def parallel_data_to_partial_tokens(nl_list, cm_list, pool):
+    return map_parallel_data(pool,
+        functools.partial(nl_to_partial_tokens,
+                          tokenizer=tokenizer.basic_tokenizer),
+        functools.partial(cm_to_partial_tokens,
+                          tokenizer=data_tools.bash_tokenizer),
+        nl_list, cm_list)
 
 
-def parallel_data_to_tokens(nl_list, cm_list):
-    nl_data = [nl_to_tokens(nl, tokenizer.basic_tokenizer) for nl in nl_list]
-    cm_data = [cm_to_tokens(cm, data_tools.bash_tokenizer) for cm in cm_list]
-    return nl_data, cm_data
+def parallel_data_to_tokens(nl_list, cm_list, pool):
+    return map_parallel_data(pool,
+        functools.partial(nl_to_tokens, tokenizer=tokenizer.basic_tokenizer),
+        functools.partial(cm_to_tokens, tokenizer=data_tools.bash_tokenizer),
+        nl_list, cm_list)
 
 
-def parallel_data_to_normalized_tokens(nl_list, cm_list):
-    nl_data = [nl_to_tokens(nl, tokenizer.ner_tokenizer) for nl in nl_list]
-    cm_data = [cm_to_tokens(cm, data_tools.bash_tokenizer, arg_type_only=True)
-               for cm in cm_list]
-    return nl_data, cm_data
+def parallel_data_to_normalized_tokens(nl_list, cm_list, pool):
+    return map_parallel_data(pool,
+        functools.partial(nl_to_tokens, tokenizer=tokenizer.ner_tokenizer),
+        functools.partial(cm_to_tokens, tokenizer=data_tools.bash_tokenizer,
+                          arg_type_only=True),
+        nl_list, cm_list)
+
+
+def map_parallel_data(pool, nl_fun, cm_fun, nl_list, cm_list):
+    """
+    Tokenize the natural language and command lists in worker processes.
+    """
+    return map_unique(pool, nl_fun, nl_list), map_unique(pool, cm_fun, cm_list)
+
+
+def map_unique(pool, fun, data, chunksize=64):
+    """
+    Apply fun to every string in data using the worker pool.
+
+    Each string is processed independently, so the list is split into chunks
+    across all cores; the output order matches the input order. Duplicate
+    strings (common for commands) are only processed once.
+    """
+    unique_data = list(collections.OrderedDict.fromkeys(data))
+    results = dict(zip(unique_data,
+                       pool.map(fun, unique_data, chunksize=chunksize)))
+    return [list(results[x]) for x in data]
 
 
 def string_to_characters(s):
     assert(isinstance(s, str))
-    chars = []
-    for c in s:
-        if c == ' ':
-            chars.append(constants._SPACE)
-        else:
-            chars.append(c)
-    return chars
+    return [constants._SPACE if c == ' ' else c for c in s]
 
 
 def nl_to_characters(nl, use_preprocessing=False):
-    nl_data_point = []
     if use_preprocessing:
         nl_tokens = nl_to_tokens(nl, tokenizer.basic_tokenizer, lemmatization=False)
-        for c in ' '.join(nl_tokens):
-            if c == ' ':
-                nl_data_point.append(constants._SPACE)
-            else:
-                nl_data_point.append(c)
+        nl_data_point = string_to_characters(' '.join(nl_tokens))
     else:
         nl_data_point = string_to_characters(nl)
     return nl_data_point
@@ -724,13 +747,7 @@ def tokens_to_ids(tokens, vocabulary):
     """
     Map tokens into their indices in the vocabulary.
     """
-    token_ids = []
-    for t in tokens:
-        if t in vocabulary:
-            token_ids.append(vocabulary[t])
-        else:
-            token_ids.append(UNK_ID)
-    return token_ids
+    return [vocabulary.get(t, UNK_ID) for t in tokens]
 
 
 def compute_copy_indices(sc_tokens, tg_tokens, sc_copy_tokens, tg_copy_tokens,
@@ -738,20 +755,24 @@ def compute_copy_indices(sc_tokens, tg_tokens, sc_copy_tokens, tg_copy_tokens,
     assert(len(sc_tokens) == len(sc_copy_tokens))
     assert(len(tg_tokens) == len(tg_copy_tokens))
     csc_ids, ctg_ids = [], []
-    init_vocab = CHAR_INIT_VOCAB if channel == 'char' else TOKEN_INIT_VOCAB
+    init_vocab = set(CHAR_INIT_VOCAB if channel == 'char' else TOKEN_INIT_VOCAB)
+    # position of the first occurrence of each source token
+    sc_token_pos = {t: i for i, t in reversed(list(enumerate(sc_tokens)))}
+    sc_copy_token_pos = \
+        {t: i for i, t in reversed(list(enumerate(sc_copy_tokens)))}
     for i, sc_token in enumerate(sc_tokens):
         if (not sc_token in init_vocab) and sc_token in tg_vocab:
             csc_ids.append(tg_vocab[sc_token])
         else:
-            csc_ids.append(len(tg_vocab) + sc_tokens.index(sc_token))
+            csc_ids.append(len(tg_vocab) + sc_token_pos[sc_token])
     for j, tg_token in enumerate(tg_tokens):
         tg_copy_token = tg_copy_tokens[j]
         if tg_token in tg_vocab:
             ctg_ids.append(tg_vocab[tg_token])
         else:
-            if tg_copy_token in sc_copy_tokens:
+            if tg_copy_token in sc_copy_token_pos:
                 ctg_ids.append(
-                    len(tg_vocab) + sc_copy_tokens.index(tg_copy_token))
+                    len(tg_vocab) + sc_copy_token_pos[tg_copy_token])
             else:
                 if channel == 'char':
                     ctg_ids.append(CUNK_ID)
@@ -778,17 +799,21 @@ def compute_pair_alignment(nl_tokens, cm_tokens, out_file):
     """
     Compute the alignments between two parallel sequences.
     """
-    init_vocab = set(TOKEN_INIT_VOCAB + CHAR_INIT_VOCAB)
     m = len(nl_tokens)
     n = len(cm_tokens)
 
     A = np.zeros([m, n], dtype=np.int32)
 
+    # positions of each (non-special) token in the command
+    cm_token_pos = collections.defaultdict(list)
+    for j, y in enumerate(cm_tokens):
+        if not y in ALL_INIT_VOCAB:
+            cm_token_pos[y].append(j)
+
     for i, x in enumerate(nl_tokens):
-        for j, y in enumerate(cm_tokens):
-            if not x in init_vocab and x == y:
-                A[i, j] = 1
-                out_file.write('{}-{} '.format(i, j))
+        for j in cm_token_pos.get(x, []):
+            A[i, j] = 1
+            out_file.write('{}-{} '.format(i, j))
     out_file.write('\n')
 
     return ssp.lil_matrix(A)
@@ -799,39 +824,36 @@ def create_vocabulary(vocab_path, dataset, min_word_frequency=1,
     """
     Compute the vocabulary of a tokenized dataset and save to file.
     """
-    vocab = collections.defaultdict(int)
-    num_copy = collections.defaultdict(int)
+    vocab = collections.Counter()
+    num_copy = collections.Counter()
     if parallel_dataset:
         for i, data_point in enumerate(dataset):
-            parallel_data_point = parallel_dataset[i]
-            for token in data_point:
-                vocab[token] += 1
-                if token in parallel_data_point:
-                    num_copy[token] += 1
+            parallel_data_point = set(parallel_dataset[i])
+            vocab.update(data_point)
+            num_copy.update(token for token in data_point
+                            if token in parallel_data_point)
         for v in vocab:
             if vocab[v] == num_copy[v]:
                 vocab[v] = 0
     else:
         for data_point in dataset:
-            for token in data_point:
-                vocab[token] += 1
-    sorted_vocab = [(x, y) for x, y in sorted(
-            vocab.items(), key=lambda x:(x[1], x[0]), reverse=True) 
-            if y >= min_word_frequency]
+            vocab.update(data_point)
+    # drop infrequent tokens before sorting
+    sorted_vocab = sorted(
+        [(x, y) for x, y in vocab.items() if y >= min_word_frequency],
+        key=lambda x:(x[1], x[0]), reverse=True)
     
     if is_character_model:
         # Character model
         init_vocab = CHAR_INIT_VOCAB
     else:
         init_vocab = TOKEN_INIT_VOCAB
+    init_vocab_set = set(init_vocab)
     vocab = [(v, 1000000) for v in init_vocab]
-    for v, f in sorted_vocab:
-        if not v in init_vocab:
-            vocab.append((v, f))
+    vocab.extend([(v, f) for v, f in sorted_vocab if not v in init_vocab_set])
 
     with open(vocab_path, 'w', encoding='utf-8') as vocab_file:
-        for v, f in vocab:
-            vocab_file.write('{}\t{}\n'.format(v, f))
+        vocab_file.writelines('{}\t{}\n'.format(v, f) for v, f in vocab)
 
     return dict([(x[0], y) for y, x in enumerate(vocab)])
 
@@ -854,17 +876,13 @@ def group_parallel_data(dataset, attribute='source', use_temp=False,
     """
     if dataset.data_points and isinstance(dataset.data_points, list):
         if isinstance(dataset.data_points[0], list):
-            data_points = functools.reduce(lambda x, y: x + y, dataset.data_points)
+            data_points = list(itertools.chain.from_iterable(dataset.data_points))
         else:
             data_points = dataset.data_points
     else:
         raise ValueError
 
-    grouped_dataset = {}
-    for i in xrange(len(data_points)):
-        data_point = data_points[i]
-        attr = data_point.sc_txt \
-            if attribute == 'source' else data_point.tg_txt
+    def get_template(attr):
         if use_temp:
             if tokenizer_selector == 'nl':
                 words, _ = tokenizer.ner_tokenizer(attr)
@@ -877,10 +895,21 @@ def group_parallel_data(dataset, attribute='source', use_temp=False,
                 temp = ' '.join(words)
             else:
                 temp = attr
-        if temp in grouped_dataset:
-            grouped_dataset[temp].append(data_point)
+        return temp
+
+    grouped_dataset = collections.defaultdict(list)
+    # duplicate attribute strings are tokenized only once
+    templates = {}
+    for i in xrange(len(data_points)):
+        data_point = data_points[i]
+        attr = data_point.sc_txt \
+            if attribute == 'source' else data_point.tg_txt
+        if attr in templates:
+            temp = templates[attr]
         else:
-            grouped_dataset[temp] = [data_point]
+            temp = get_template(attr)
+            templates[attr] = temp
+        grouped_dataset[temp].append(data_point)
     return sorted(grouped_dataset.items(), key=lambda x: x[0])
 
 
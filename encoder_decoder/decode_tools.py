@@ -2,6 +2,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
+import collections
+import copy
+import functools
 import os
 import sys
 
@@ -25,6 +29,8 @@ from nlp_tools import constants, format_args, tokenizer
 
 APOLOGY_MSG = "Sorry, I don't know how to translate this command."
 
+_SEMICOLON_RE = re.compile(r'( ;\s+)|( ;$)')
+
 
 def demo(sess, model, FLAGS):
     """
@@ -36,15 +42,12 @@ def demo(sess, model, FLAGS):
     sentence = sys.stdin.readline()
 
     vocabs = data_utils.load_vocabulary(FLAGS)
+    slot_filling_classifier = get_slot_filling_classifer(FLAGS) \
+        if FLAGS.fill_argument_slots else None
 
     while sentence:
-        if FLAGS.fill_argument_slots:
-            slot_filling_classifier = get_slot_filling_classifer(FLAGS)
-            batch_outputs, sequence_logits = translate_fun(sentence, sess, model,
-                vocabs, FLAGS, slot_filling_classifier=slot_filling_classifier)
-        else:
-            batch_outputs, sequence_logits = translate_fun(sentence, sess, model,
-                vocabs, FLAGS)
+        batch_outputs, sequence_logits = translate_fun(sentence, sess, model,
+            vocabs, FLAGS, slot_filling_classifier=slot_filling_classifier)
         if FLAGS.token_decoding_algorithm == 'greedy':
             tree, pred_cmd, outputs = batch_outputs[0]
             score = sequence_logits[0]
@@ -69,55 +72,108 @@ def demo(sess, model, FLAGS):
 
 def translate_fun(data_point, sess, model, vocabs, FLAGS,
                   slot_filling_classifier=None):
-    tg_ids = [data_utils.ROOT_ID]
-    decoder_features = [[tg_ids]]
-    if type(data_point) is str:
-        source_str = data_point
-        encoder_features = query_to_encoder_features(data_point, vocabs, FLAGS)
-    else:
-        source_str = data_point[0].sc_txt
-        encoder_features = [[data_point[0].sc_ids]]
-        if FLAGS.use_copy and FLAGS.copy_fun == 'copynet':
-            encoder_features.append([data_point[0].csc_ids])
+    return translate_batch([data_point], sess, model, vocabs, FLAGS,
+        slot_filling_classifier=slot_filling_classifier)[0]
 
-    if FLAGS.use_copy and FLAGS.copy_fun == 'copynet':
+
+def translate_batch(data_points, sess, model, vocabs, FLAGS,
+                    slot_filling_classifier=None, top_k=20):
+    """
+    Translate a batch of inputs with a single model step.
+
+    :param data_points: list of natural language strings or dev/test data
+        groups; the batch is run in the bucket of its longest source.
+    :return: list of (batch_outputs, sequence_logits) tuples, one for each
+        input, in the format returned by translate_fun.
+    :param top_k: maximum number of predictions to decode for each input.
+    """
+    use_copynet = FLAGS.use_copy and FLAGS.copy_fun == 'copynet'
+    source_strs, sc_ids, csc_ids = [], [], []
+    for data_point in data_points:
+        if type(data_point) is str:
+            source_strs.append(data_point)
+            encoder_features = query_to_encoder_features(data_point, vocabs, FLAGS)
+            sc_ids.append(encoder_features[0][0])
+            if use_copynet:
+                csc_ids.append(encoder_features[1][0])
+        else:
+            source_strs.append(data_point[0].sc_txt)
+            sc_ids.append(data_point[0].sc_ids)
+            if use_copynet:
+                csc_ids.append(data_point[0].csc_ids)
+
+    # The decoding graph has a fixed batch size: fill up the batch with copies
+    # of the last input and discard their outputs.
+    batch_size = len(data_points)
+    num_paddings = max(model.batch_size - batch_size, 0)
+    tg_ids = [data_utils.ROOT_ID]
+    encoder_features = [sc_ids + [sc_ids[-1]] * num_paddings]
+    decoder_features = [[tg_ids] * (batch_size + num_paddings)]
+    if use_copynet:
+        encoder_features.append(csc_ids + [csc_ids[-1]] * num_paddings)
         # append dummy copynet target features (
         # used only for computing training objectives)
         ctg_ids = [data_utils.ROOT_ID]
-        decoder_features.append([ctg_ids])
+        decoder_features.append([ctg_ids] * (batch_size + num_paddings))
         # tokenize the source string with minimal changes on the token form
-        copy_tokens = [query_to_copy_tokens(source_str, FLAGS)]
+        copy_tokens = [query_to_copy_tokens(source_str, FLAGS)
+                       for source_str in source_strs]
     else:
         copy_tokens = None
     if FLAGS.normalized:
-        _, entities = tokenizer.ner_tokenizer(source_str)
-        sc_fillers = [entities[0]]
+        sc_fillers = [ner_tokenize(source_str)[1][0]
+                      for source_str in source_strs]
     else:
         sc_fillers = None
 
     # Which bucket does it belong to?
-    bucket_ids = [b for b in xrange(len(model.buckets))
-                  if model.buckets[b][0] > len(encoder_features[0][0])]
-    bucket_id = min(bucket_ids) if bucket_ids else (len(model.buckets) - 1)
-    
-    # Get a 1-element batch to feed the sentence to the model.
+    bucket_id = get_bucket_id(model, max(len(x) for x in sc_ids))
+
     formatted_example = model.format_batch(
         encoder_features, decoder_features, bucket_id=bucket_id)
 
     # Compute neural network decoding output
     model_outputs = model.step(sess, formatted_example, bucket_id,
                                forward_only=True)
-    sequence_logits = model_outputs.sequence_logits
 
-    decoded_outputs = decode(model_outputs, FLAGS, vocabs, sc_fillers=sc_fillers,
-                             slot_filling_classifier=slot_filling_classifier,
-                             copy_tokens=copy_tokens)
+    translations = []
+    for batch_id in xrange(batch_size):
+        example_outputs = get_example_outputs(model_outputs, batch_id, FLAGS)
+        decoded_outputs = decode(example_outputs, FLAGS, vocabs,
+            sc_fillers=sc_fillers[batch_id:batch_id+1] if sc_fillers else None,
+            slot_filling_classifier=slot_filling_classifier,
+            copy_tokens=copy_tokens[batch_id:batch_id+1] if copy_tokens else None,
+            top_k=top_k)
+        translations.append((decoded_outputs, example_outputs.sequence_logits))
+    return translations
+
+
+def get_bucket_id(model, source_length):
+    """
+    Return the smallest bucket that fits a source sequence of the given length.
+    """
+    bucket_id = bisect.bisect_right(model.bucket_sc_sizes, source_length)
+    return min(bucket_id, len(model.buckets) - 1)
+
 
-    return decoded_outputs, sequence_logits
+def get_example_outputs(model_outputs, batch_id, FLAGS):
+    """
+    Slice the outputs of one example out of a batched model output.
+    """
+    beam_size = FLAGS.beam_size \
+        if FLAGS.token_decoding_algorithm == 'beam_search' else 1
+    O = copy.copy(model_outputs)
+    O.output_symbols = model_outputs.output_symbols[batch_id:batch_id+1]
+    O.sequence_logits = model_outputs.sequence_logits[batch_id:batch_id+1]
+    O.encoder_hidden_states = \
+        model_outputs.encoder_hidden_states[batch_id:batch_id+1]
+    O.decoder_hidden_states = model_outputs.decoder_hidden_states[
+        batch_id*beam_size:(batch_id+1)*beam_size]
+    return O
 
 
 def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
-           slot_filling_classifier=None, copy_tokens=None):
+           slot_filling_classifier=None, copy_tokens=None, top_k=20):
     """
     Transform the neural network output into readable strings and apply output
     filtering (if any).
@@ -127,12 +183,15 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
     :param vocabs:
     :param sc_fillers:
     :param slot_filling_classifier:
+    :param top_k: stop after this many valid predictions have been produced.
     :return batch_outputs: nested list of (target_ast, target) tuples
         - target_ast is a python tree object for target languages that we know
           how to parse and a dummy string for those we don't
         - target is the output string
     """
     rev_tg_vocab = vocabs.rev_tg_vocab
+    clean_rev_tg_vocab = vocabs.clean_rev_tg_vocab
+    use_copynet = FLAGS.use_copy and FLAGS.copy_fun == 'copynet'
 
     encoder_outputs = model_outputs.encoder_hidden_states
     decoder_outputs = model_outputs.decoder_hidden_states
@@ -149,19 +208,10 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
     num_output_examples = 0
 
     for batch_id in xrange(batch_size):
-        def as_str(output, r_tg_vocab):
-            if output < FLAGS.tg_vocab_size:
-                token = r_tg_vocab[output]
-            else:
-                if FLAGS.use_copy and FLAGS.copy_fun == 'copynet':
-                    source_id = output - FLAGS.tg_vocab_size
-                    if source_id >= 0 and source_id < len(copy_tokens[batch_id]):
-                        token = copy_tokens[batch_id][source_id]
-                    else:
-                        return data_utils._UNK
-                else:
-                    return data_utils._UNK
-            return token
+        if use_copynet:
+            example_copy_tokens = copy_tokens[batch_id]
+            clean_copy_tokens = [t.split(data_tools.flag_suffix)[0]
+                                 for t in example_copy_tokens]
 
         top_k_predictions = output_symbols[batch_id]
         if FLAGS.token_decoding_algorithm == 'beam_search':
@@ -174,72 +224,76 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
         for beam_id in xrange(len(top_k_predictions)):
             # Step 1: transform the neural network output into readable strings
             prediction = top_k_predictions[beam_id]
-            outputs = [int(pred) for pred in prediction]
-            
-            # If there is an EOS symbol in outputs, cut them at that point.
-            if data_utils.EOS_ID in outputs:
-                outputs = outputs[:outputs.index(data_utils.EOS_ID)]
-            if data_utils.PAD_ID in outputs:
-                outputs = outputs[:outputs.index(data_utils.PAD_ID)]
-            output_tokens = []
+            # Cut the outputs at the first EOS or PAD symbol. output_tokens
+            # have the flag suffixes removed; ids beyond the target vocabulary
+            # are copied from the source (copynet) or mapped to UNK.
+            raw_tokens, output_tokens = [], []
+            for pred in prediction:
+                pred = int(pred)
+                if pred == data_utils.EOS_ID or pred == data_utils.PAD_ID:
+                    break
+                if pred < FLAGS.tg_vocab_size:
+                    raw_tokens.append(rev_tg_vocab[pred])
+                    output_tokens.append(clean_rev_tg_vocab[pred])
+                elif use_copynet and \
+                        pred - FLAGS.tg_vocab_size < len(example_copy_tokens):
+                    source_id = pred - FLAGS.tg_vocab_size
+                    raw_tokens.append(example_copy_tokens[source_id])
+                    output_tokens.append(clean_copy_tokens[source_id])
+                else:
+                    raw_tokens.append(data_utils._UNK)
+                    output_tokens.append(data_utils._UNK)
+
             tg_slots = {}
-            for token_id in xrange(len(outputs)):
-                output = outputs[token_id]
-                pred_token = as_str(output, rev_tg_vocab)
-                if data_tools.flag_suffix in pred_token:
-                    pred_token = pred_token.split(data_tools.flag_suffix)[0]
+            for token_id, pred_token in enumerate(output_tokens):
                 # process argument slots
                 if pred_token in bash.argument_types:
                     if token_id > 0 and format_args.is_min_flag(
-                        rev_tg_vocab[outputs[token_id-1]]):
+                            raw_tokens[token_id-1]):
                         pred_token_type = 'Timespan'
                     else:
                         pred_token_type = pred_token
                     tg_slots[token_id] = (pred_token, pred_token_type)
-                output_tokens.append(pred_token)
 
             if FLAGS.channel == 'partial.token':
                 # process partial-token outputs
                 merged_output_tokens = []
-                buffer = ''
+                buffer = []
                 load_buffer = False
                 for token in output_tokens:
                     if load_buffer:
                         if token == data_utils._ARG_END:
-                            merged_output_tokens.append(buffer)
+                            merged_output_tokens.append(''.join(buffer))
                             load_buffer = False
-                            buffer = ''
+                            buffer = []
                         else:
-                            buffer += token
+                            buffer.append(token)
                     else:
                         if token == data_utils._ARG_START:
                             load_buffer = True
                         else:
                             merged_output_tokens.append(token)
+                buffer = ''.join(buffer)
                 if buffer:
                     merged_output_tokens.append(buffer)
                 output_tokens = merged_output_tokens
     
             if FLAGS.channel == 'char':
-                target = ''
-                for char in output_tokens:
-                    if char == data_utils.constants._SPACE:
-                        target += ' '
-                    else:
-                        target += char
+                target = ''.join([' ' if char == constants._SPACE else char
+                                  for char in output_tokens])
             else:
                 target = ' '.join(output_tokens)
             
             # Step 2: checvik if the predicted command template is grammatical
             if FLAGS.grammatical_only and not FLAGS.explain:
                 if FLAGS.dataset.startswith('bash'):
-                    target = re.sub('( ;\s+)|( ;$)', ' \\; ', target)
-                    target_ast = data_tools.bash_parser(target, verbose=False)
+                    target = _SEMICOLON_RE.sub(' \\; ', target)
+                    target_ast = parse_bash_template(target)
                 elif FLAGS.dataset.startswith('regex'):
                     # TODO: check if a predicted regular expression is legal
                     target_ast = '__DUMMY_TREE__'
                 else:
-                    target_ast = data_tools.paren_parser(target)
+                    target_ast = parse_paren_template(target)
                 # filter out non-grammatical output
                 if target_ast is None:
                     continue
@@ -276,7 +330,7 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
                 num_output_examples += 1
 
             # The threshold is used to increase decoding speed
-            if num_output_examples == 20:
+            if num_output_examples >= top_k:
                 break
 
         if FLAGS.token_decoding_algorithm == 'beam_search':
@@ -286,6 +340,27 @@ def decode(model_outputs, FLAGS, vocabs, sc_fillers=None,
     return batch_outputs
 
 
+# The same templates are predicted over and over across beams and examples,
+# so the parse of each distinct prediction is cached. The cached ASTs are
+# shared and must not be modified.
+@functools.lru_cache(maxsize=100000)
+def parse_bash_template(target):
+    return data_tools.bash_parser(target, verbose=False)
+
+
+@functools.lru_cache(maxsize=100000)
+def parse_paren_template(target):
+    return data_tools.paren_parser(target)
+
+
+# Source sentences are NER-tokenized both for the encoder features and for the
+# slot fillers, and the same sentence can be decoded repeatedly (paraphrase
+# groups, resubmitted demo queries). The cached results must not be modified.
+@functools.lru_cache(maxsize=50000)
+def ner_tokenize(sentence):
+    return tokenizer.ner_tokenizer(sentence)
+
+
 def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
     """
     Compute top-k predictions on the dev/test dataset and write the predictions
@@ -308,38 +383,58 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
     ts = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H%M%S')
     pred_file_path = os.path.join(model.model_dir, 'predictions.{}.{}'.format(
         model.decode_sig, ts))
-    pred_file = open(pred_file_path, 'w')
+    pred_file = open(pred_file_path, 'w', buffering=1<<20)
     eval_file_path = os.path.join(model.model_dir, 'predictions.{}.{}.csv'.format(
         model.decode_sig, ts))
     eval_file = open(eval_file_path, 'w')
     eval_file.write('example_id, description, ground_truth, prediction, ' +
                     'correct template, correct command\n')
+
+    slot_filling_classifier = get_slot_filling_classifer(FLAGS) \
+        if FLAGS.fill_argument_slots else None
+
+    # Decode the examples in batches of examples from the same bucket
+    bucketed_example_ids = collections.defaultdict(list)
+    for example_id in xrange(len(grouped_dataset)):
+        data_group = grouped_dataset[example_id][1]
+        bucket_id = get_bucket_id(model, len(data_group[0].sc_ids))
+        bucketed_example_ids[bucket_id].append(example_id)
+    translations = [None] * len(grouped_dataset)
+    for example_ids in bucketed_example_ids.values():
+        for i in xrange(0, len(example_ids), model.batch_size):
+            batch_example_ids = example_ids[i:i+model.batch_size]
+            data_groups = [grouped_dataset[example_id][1]
+                           for example_id in batch_example_ids]
+            batch_translations = translate_batch(data_groups, sess, model,
+                vocabs, FLAGS, slot_filling_classifier=slot_filling_classifier,
+                top_k=top_k)
+            for example_id, translation in \
+                    zip(batch_example_ids, batch_translations):
+                translations[example_id] = translation
+
+    # Screen output is buffered and written out every 100 examples
+    log_lines = []
     for example_id in xrange(len(grouped_dataset)):
         key, data_group = grouped_dataset[example_id]
 
         sc_txt = data_group[0].sc_txt.strip()
-        sc_tokens = [rev_sc_vocab[i] for i in data_group[0].sc_ids]
-        if FLAGS.channel == 'char':
-            sc_temp = ''.join(sc_tokens)
-            sc_temp = sc_temp.replace(constants._SPACE, ' ')
-        else:
-            sc_temp = ' '.join(sc_tokens)
         tg_txts = [dp.tg_txt for dp in data_group]
         tg_asts = [data_tools.bash_parser(tg_txt) for tg_txt in tg_txts]
         if verbose:
-            print('\nExample {}:'.format(example_id))
-            print('Original Source: {}'.format(sc_txt.encode('utf-8')))
-            print('Source: {}'.format(sc_temp.encode('utf-8')))
+            sc_tokens = [rev_sc_vocab[i] for i in data_group[0].sc_ids]
+            if FLAGS.channel == 'char':
+                sc_temp = ''.join(sc_tokens)
+                sc_temp = sc_temp.replace(constants._SPACE, ' ')
+            else:
+                sc_temp = ' '.join(sc_tokens)
+            log_lines.append('\nExample {}:'.format(example_id))
+            log_lines.append('Original Source: {}'.format(sc_txt.encode('utf-8')))
+            log_lines.append('Source: {}'.format(sc_temp.encode('utf-8')))
             for j in xrange(len(data_group)):
-                print('GT Target {}: {}'.format(j+1, data_group[j].tg_txt.encode('utf-8')))
+                log_lines.append('GT Target {}: {}'.format(
+                    j+1, data_group[j].tg_txt.encode('utf-8')))
 
-        if FLAGS.fill_argument_slots:
-            slot_filling_classifier = get_slot_filling_classifer(FLAGS)
-            batch_outputs, sequence_logits = translate_fun(data_group, sess, model,
-                vocabs, FLAGS, slot_filling_classifier=slot_filling_classifier)
-        else:
-            batch_outputs, sequence_logits = translate_fun(data_group, sess, model,
-                vocabs, FLAGS)
+        batch_outputs, sequence_logits = translations[example_id]
         if FLAGS.tg_char:
             batch_outputs, batch_char_outputs = batch_outputs
 
@@ -352,7 +447,7 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
                         tree, loose_constraints=True)
                 score = sequence_logits[0]
                 if verbose:
-                    print('Prediction: {} ({})'.format(pred_cmd, score))
+                    log_lines.append('Prediction: {} ({})'.format(pred_cmd, score))
                 pred_file.write('{}\n'.format(pred_cmd))
             elif FLAGS.token_decoding_algorithm == 'beam_search':
                 top_k_predictions = batch_outputs[0]
@@ -360,6 +455,7 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
                     top_k_char_predictions = batch_char_outputs[0]
                 top_k_scores = sequence_logits[0]
                 num_preds = min(FLAGS.beam_size, top_k, len(top_k_predictions))
+                pred_line = []
                 for j in xrange(num_preds):
                     if j > 0:
                         eval_row = ',,'
@@ -373,7 +469,7 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
                             top_k_pred_tree, loose_constraints=True)
                     else:
                         pred_cmd = top_k_pred_cmd
-                    pred_file.write('{}|||'.format(pred_cmd.encode('utf-8')))
+                    pred_line.append('{}|||'.format(pred_cmd.encode('utf-8')))
                     eval_row += '"{}",'.format(pred_cmd.replace('"', '""'))
                     temp_match = tree_dist.one_match(
                         tg_asts, top_k_pred_tree, ignore_arg_value=True)
@@ -385,18 +481,24 @@ def decode_set(sess, model, dataset, top_k, FLAGS, verbose=False):
                         eval_row += 'y'
                     eval_file.write('{}\n'.format(eval_row.encode('utf-8')))
                     if verbose:
-                        print('Prediction {}: {} ({})'.format(
+                        log_lines.append('Prediction {}: {} ({})'.format(
                             j+1, pred_cmd.encode('utf-8'), top_k_scores[j]))
                         if FLAGS.tg_char:
-                            print('Character-based prediction {}: {}'.format(
+                            log_lines.append('Character-based prediction {}: {}'.format(
                                 j+1, top_k_char_predictions[j].encode('utf-8')))
-                pred_file.write('\n')
+                pred_line.append('\n')
+                pred_file.write(''.join(pred_line))
         else:
-            print(APOLOGY_MSG)
+            log_lines.append(APOLOGY_MSG)
             pred_file.write('\n')
             eval_file.write('{}\n'.format(eval_row))
             eval_file.write('\n')
             eval_file.write('\n')
+        if log_lines and (example_id + 1) % 100 == 0:
+            sys.stdout.write('\n'.join(log_lines) + '\n')
+            log_lines = []
+    if log_lines:
+        sys.stdout.write('\n'.join(log_lines) + '\n')
     pred_file.close()
     eval_file.close()
     shutil.copyfile(pred_file_path, os.path.join(FLAGS.model_dir,
@@ -429,7 +531,7 @@ def query_to_encoder_features(sentence, vocabs, FLAGS):
         init_vocab = data_utils.TOKEN_INIT_VOCAB
     else:
         if FLAGS.normalized:
-            tokens = data_utils.nl_to_tokens(sentence, tokenizer.ner_tokenizer)
+            tokens = ner_tokenize(sentence)[0]
         else:
             tokens = data_utils.nl_to_tokens(sentence, tokenizer.basic_tokenizer)
         init_vocab = data_utils.TOKEN_INIT_VOCAB
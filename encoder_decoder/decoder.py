@@ -34,8 +34,6 @@ class Decoder(graph_utils.NNModel):
             2. "beam_search"
         """
         super(Decoder, self).__init__(hyperparameters)
-        if self.forward_only:
-            self.hyperparams['batch_size'] = 1
 
         self.scope = scope
         self.dim = dim
@@ -47,10 +45,6 @@ class Decoder(graph_utils.NNModel):
         self.decoding_algorithm = decoding_algorithm
 
         self.vocab_size = self.target_vocab_size
-        
-        # variable sharing
-        self.embedding_vars = False
-        self.output_project_vars = False
 
         self.beam_decoder = beam_search.BeamDecoder(
                 self.num_layers,
@@ -68,14 +62,14 @@ class Decoder(graph_utils.NNModel):
         self.output_project = self.output_project()
 
     def embeddings(self):
-        with tf.compat.v1.variable_scope(self.scope + "_embeddings", reuse=self.embedding_vars):
+        with tf.compat.v1.variable_scope(self.scope + "_embeddings",
+                                         reuse=tf.compat.v1.AUTO_REUSE):
             vocab_size = self.target_vocab_size
             print("target token embedding size = {}".format(vocab_size))
             sqrt3 = math.sqrt(3)
             initializer = tf.compat.v1.random_uniform_initializer(-sqrt3, sqrt3)
             embeddings = tf.compat.v1.get_variable("embedding",
                 [vocab_size, self.embedding_dim], initializer=initializer)
-            self.embedding_vars = True
             return embeddings
 
     def token_features(self):
@@ -83,10 +77,9 @@ class Decoder(graph_utils.NNModel):
 
     def output_project(self):
         with tf.compat.v1.variable_scope(self.scope + "_output_project",
-                               reuse=self.output_project_vars):
+                               reuse=tf.compat.v1.AUTO_REUSE):
             w = tf.compat.v1.get_variable("proj_w", [self.dim, self.vocab_size])
             b = tf.compat.v1.get_variable("proj_b", [self.vocab_size])
-            self.output_project_vars = True
         return (w, b)
 
 
@@ -102,6 +95,11 @@ class CopyCellWrapper(tf.compat.v1.nn.rnn_cell.RNNCell):
         # [batch_size x max_source_length]
         self.encoder_copy_inputs = \
             tf.concat(axis=1, values=[tf.expand_dims(x, 1) for x in encoder_copy_inputs])
+        # Maps the copy probability of each source position to the extended
+        # vocabulary; the same in every decoding step
+        # [batch_size x max_source_length x (tg_vocab_size + max_source_length)]
+        self.copy_vocab_indices = tf.one_hot(self.encoder_copy_inputs,
+            depth=self.tg_vocab_size+self.encoder_size)
 
         print("CopyCellWrapper added!")
 
@@ -120,7 +118,7 @@ class CopyCellWrapper(tf.compat.v1.nn.rnn_cell.RNNCell):
         gen_prob = tf.slice(prob, [0, 0], [-1, self.tg_vocab_size])
         copy_prob = tf.slice(prob, [0, self.tg_vocab_size], [-1, -1])
         copy_vocab_prob = tf.squeeze(tf.matmul(tf.expand_dims(copy_prob, 1),
-            tf.one_hot(self.encoder_copy_inputs, depth=self.tg_vocab_size+copy_prob.get_shape()[1])), 1)
+            self.copy_vocab_indices), 1)
 
         # mixture probability
         mix_prob = tf.concat([gen_prob, tf.zeros(tf.shape(input=copy_prob))], 1) + \
@@ -158,11 +156,17 @@ class AttentionCellWrapper(tf.compat.v1.nn.rnn_cell.RNNCell):
                   .format(attention_input_keep))
             attention_states = tf.nn.dropout(
                 attention_states, 1 - (attention_input_keep))
-        attn_length = attention_states.get_shape()[1]
-        attn_dim = attention_states.get_shape()[2]
+        # The attention graph is built for a fixed encoder length (bucket)
+        attn_length = tf.compat.v1.dimension_value(attention_states.get_shape()[1])
+        attn_dim = tf.compat.v1.dimension_value(attention_states.get_shape()[2])
+        assert(attn_length is not None and attn_dim is not None)
 
         self.cell = cell
         self.encoder_attn_masks = encoder_attn_masks
+        # Additive bias which masks out the padded positions of the attention
+        # scores, computed once for all decoder steps
+        # [batch_size x attn_length]
+        self.attn_bias = (encoder_attn_masks - 1) * 1e12
         self.vocab_indices = tf.linalg.tensor_diag(tf.ones(tg_vocab_size))
         self.num_heads = num_heads
         self.dim = dim
@@ -180,6 +184,26 @@ class AttentionCellWrapper(tf.compat.v1.nn.rnn_cell.RNNCell):
                 hidden_features.append(attention_states)
         self.hidden_features = hidden_features
 
+        if attention_function == 'non-linear':
+            # The score v^T * tanh(W * [h; s]) splits into W_h * h + W_s * s.
+            # W_h * h does not depend on the decoder state, so it is computed
+            # once here instead of in every decoder step.
+            self.hidden_projections = []
+            self.state_projections = []
+            self.score_vectors = []
+            for a in xrange(num_heads):
+                with tf.compat.v1.variable_scope("Attention_%d" % a):
+                    k = tf.compat.v1.get_variable("AttnW_%d" % a,
+                                                  [1, 1, 2*attn_dim, attn_dim])
+                    l = tf.compat.v1.get_variable("Attnl_%d" % a,
+                                                  [1, 1, 1, attn_dim])
+                    k_h, k_s = tf.split(k[0, 0], 2, axis=0)
+                    # [batch_size, attn_length, attn_dim]
+                    self.hidden_projections.append(
+                        tf.einsum('bld,de->ble', hidden_features[a], k_h))
+                    self.state_projections.append(k_s)
+                    self.score_vectors.append(tf.reshape(l, [-1]))
+
         self.use_copy = use_copy
 
         print("AttentionCellWrapper added!")
@@ -195,37 +219,37 @@ class AttentionCellWrapper(tf.compat.v1.nn.rnn_cell.RNNCell):
                 if ndims:
                     assert ndims == 2
             state = tf.concat(axis=1, values=query_list)
+        if self.attention_function == 'inner_product':
+            # The heads read the same attention states with the same query and
+            # have no parameters of their own, so they share the scores.
+            # [batch_size x attn_length]
+            inner_product_s = tf.einsum(
+                'bld,bd->bl', self.hidden_features[0], state)
+            inner_product_s = inner_product_s + self.attn_bias
         for a in xrange(self.num_heads):
             with tf.compat.v1.variable_scope("Attention_%d" % a):
-                y = tf.reshape(state, [-1, 1, 1, self.attn_dim])
                 # Attention mask is a softmax of v^T * tanh(...).
                 if self.attention_function == 'non-linear':
-                    k = tf.compat.v1.get_variable("AttnW_%d" % a,
-                                        [1, 1, 2*self.attn_dim, self.attn_dim])
-                    l = tf.compat.v1.get_variable("Attnl_%d" % a,
-                                        [1, 1, 1, self.attn_dim])
-                    z = tf.reshape(self.hidden_features[a],
-                                   [-1, self.attn_length, 1, self.attn_dim])
-                    v = tf.concat(axis=3, values=[z, tf.tile(y, [1, self.attn_length, 1, 1])])
-                    s = tf.reduce_sum(
-                        input_tensor=l * tf.tanh(tf.nn.conv2d(input=v, filters=k, strides=[1,1,1,1], padding="SAME")), axis=[2, 3])
+                    y = tf.expand_dims(
+                        tf.matmul(state, self.state_projections[a]), 1)
+                    s = tf.einsum('bld,d->bl',
+                                  tf.tanh(self.hidden_projections[a] + y),
+                                  self.score_vectors[a])
+                    # Apply attention masks
+                    # [batch_size x attn_length]
+                    s = s + self.attn_bias
                 elif self.attention_function == 'inner_product':
-                    s = tf.reduce_sum(input_tensor=tf.multiply(self.hidden_features[a], y), axis=[2])
+                    s = inner_product_s
                 else:
                     raise NotImplementedError
 
-                # Apply attention masks
-                # [batch_size x attn_length]
-                s = s - (1 - self.encoder_attn_masks) * 1e12
                 if a == 0:
                     alignment = tf.nn.softmax(s)    # normalized
                     alignments.append(alignment)
                     # Soft attention read
-                    d = tf.reduce_sum(
-                        input_tensor=tf.reshape(alignment, [-1, self.attn_length, 1])
-                            * self.hidden_features[a], axis=[1])
                     # [batch_size, attn_dim]
-                    context = tf.reshape(d, [-1, self.attn_dim])
+                    context = tf.einsum(
+                        'bl,bld->bd', alignment, self.hidden_features[a])
                 else:
                     # Unnormalized
                     alignments.append(s)    # unnormalized
@@ -245,8 +269,8 @@ class AttentionCellWrapper(tf.compat.v1.nn.rnn_cell.RNNCell):
         #                          [cell_output, attns[0]], self.dim, True)),
         #                          self.attention_output_keep# )
 
-        with tf.compat.v1.variable_scope("AttnOutputProjection"):
+        with tf.compat.v1.variable_scope("AttnOutputProjection",
+                                         reuse=tf.compat.v1.AUTO_REUSE):
             output = graph_utils.linear([cell_output, attns[0]], self.dim, True)
 
-        self.attention_cell_vars = True
         return output, state, alignments, attns
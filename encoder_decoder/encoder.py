@@ -20,11 +20,6 @@ class Encoder(graph_utils.NNModel):
     def __init__(self, hyperparameters, input_keep, output_keep):
         super(Encoder, self).__init__(hyperparameters)
 
-        # variable reuse
-        self.char_embedding_vars = False
-        self.token_embedding_vars = False
-        self.char_rnn_vars = False
-
         self.input_keep = input_keep
         self.output_keep = output_keep
 
@@ -74,25 +69,23 @@ class Encoder(graph_utils.NNModel):
         :return: token embedding matrix [source_vocab_size, dim]
         """
         with tf.compat.v1.variable_scope("encoder_token_embeddings",
-                               reuse=self.token_embedding_vars):
+                               reuse=tf.compat.v1.AUTO_REUSE):
             vocab_size = self.source_vocab_size
             print("source token embedding size = {}".format(vocab_size))
             sqrt3 = math.sqrt(3)
             initializer = tf.compat.v1.random_uniform_initializer(-sqrt3, sqrt3)
             embeddings = tf.compat.v1.get_variable("embedding",
                 [vocab_size, self.sc_token_dim], initializer=initializer)
-            self.token_embedding_vars = True
             return embeddings
 
     def char_embeddings(self):
         with tf.compat.v1.variable_scope("encoder_char_embeddings",
-                               reuse=self.char_embedding_vars):
+                               reuse=tf.compat.v1.AUTO_REUSE):
             sqrt3 = math.sqrt(3)
             initializer = tf.compat.v1.random_uniform_initializer(-sqrt3, sqrt3)
             embeddings = tf.compat.v1.get_variable(
                 "embedding", [self.source_char_vocab_size, self.sc_char_dim],
                 initializer=initializer)
-            self.char_embedding_vars = True
             return embeddings
 
     def token_channel_embeddings(self):
@@ -114,14 +107,13 @@ class Encoder(graph_utils.NNModel):
                             for input in inputs]
         if self.sc_char_composition == 'rnn':
             with tf.compat.v1.variable_scope("encoder_char_rnn",
-                                   reuse=self.char_rnn_vars) as scope:
+                                   reuse=tf.compat.v1.AUTO_REUSE) as scope:
                 cell = graph_utils.create_multilayer_cell(
                     self.sc_char_rnn_cell, scope,
                     self.sc_char_dim, self.sc_char_rnn_num_layers,
                     variational_recurrent=self.variational_recurrent_dropout)
                 rnn_outputs, rnn_states = graph_utils.RNNModel(cell, input_embeddings,
                                                                dtype=tf.float32)
-                self.char_rnn_vars = True
         else:
             raise NotImplementedError
 
@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
 import sys
 if sys.version_info > (3, 0):
     from six.moves import xrange
@@ -44,6 +45,8 @@ class EncoderDecoderModel(graph_utils.NNModel):
           use_attention: if set, use attention model.
         """
         super(EncoderDecoderModel, self).__init__(hyperparams, buckets)
+        # Reusable numpy buffers for the fed-in batches (see format_batch)
+        self.feed_buffers = {}
         self.learning_rate = tf.Variable(
             float(hyperparams["learning_rate"]), trainable=False)
         self.learning_rate_decay_op = self.learning_rate.assign(
@@ -202,25 +205,41 @@ class EncoderDecoderModel(graph_utils.NNModel):
                     epsilon=self.adam_epsilon, )
             else:
                 raise ValueError("Unrecognized optimizer type.")
+            if self.mixed_precision:
+                # The float16 casts are inserted by the auto_mixed_precision
+                # grappler pass enabled in the session config; gradients must
+                # come from the wrapped optimizer so that the loss is scaled
+                # and the gradients unscaled.
+                opt = tf.compat.v1.train.experimental.MixedPrecisionLossScaleOptimizer(
+                    opt, 'dynamic')
+
+            def compute_gradients(loss):
+                if self.mixed_precision:
+                    return [g for g, _ in opt.compute_gradients(loss, var_list=params)]
+                return tf.gradients(ys=loss, xs=params)
 
             if self.buckets:
                 self.gradient_norms = []
                 self.updates = []
                 for bucket_id, _ in enumerate(self.buckets):
-                    gradients = tf.gradients(ys=self.losses[bucket_id], xs=params)
+                    gradients = compute_gradients(self.losses[bucket_id])
                     clipped_gradients, norm = tf.clip_by_global_norm(
                         gradients, self.max_gradient_norm)
                     self.gradient_norms.append(norm)
                     self.updates.append(opt.apply_gradients(
                         zip(clipped_gradients, params)))
             else:
-                gradients = tf.gradients(ys=self.losses, xs=params)
+                gradients = compute_gradients(self.losses)
                 clipped_gradients, norm = tf.clip_by_global_norm(
                     gradients, self.max_gradient_norm)
                 self.gradient_norms = norm
                 self.updates = opt.apply_gradients(zip(clipped_gradients, params))
 
-        self.saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables())
+        # Sharded V2 checkpoints are written per device in parallel
+        self.saver = tf.compat.v1.train.Saver(
+            tf.compat.v1.global_variables(), sharded=True,
+            write_version=tf.compat.v1.train.SaverDef.V2,
+            save_relative_paths=True)
 
 
     def encode_decode(self, encoder_channel_inputs, encoder_attn_masks,
@@ -305,7 +324,8 @@ class EncoderDecoderModel(graph_utils.NNModel):
                     graph_utils.softmax_loss(
                         self.char_decoder.output_project,
                         self.tg_char_vocab_size / 2,
-                        self.tg_char_vocab_size))
+                        self.tg_char_vocab_size),
+                    sampled=True)
             else:
                 encoder_decoder_char_loss = 0
 
@@ -350,15 +370,33 @@ class EncoderDecoderModel(graph_utils.NNModel):
 
 
     # Loss functions.
-    def sequence_loss(self, logits, targets, target_weights, loss_function):
+    def sequence_loss(self, logits, targets, target_weights, loss_function,
+                      sampled=False):
         assert(len(logits) == len(targets))
         with tf.compat.v1.variable_scope("sequence_loss"):
-            log_perp_list = []
-            for logit, target, weight in zip(logits, targets, target_weights):
-                crossent = loss_function(logit, target)
-                log_perp_list.append(crossent * weight)
-            log_perps = tf.add_n(log_perp_list)
-            total_size = tf.add_n(target_weights)
+            if sampled:
+                # A sampled loss draws its negative samples once per call:
+                # keep one call per time step so that every step gets its
+                # own sample set
+                # [seq_len, batch_size]
+                crossent = tf.stack([loss_function(logit, target)
+                                     for logit, target in zip(logits, targets)])
+            else:
+                # Apply the loss function to all time steps at once by folding
+                # the time dimension into the batch dimension
+                # [seq_len, batch_size, vocab_size]
+                logits = tf.stack(logits)
+                # [seq_len, batch_size]
+                targets = tf.stack(targets)
+                crossent = loss_function(
+                    tf.reshape(logits, [-1, tf.compat.v1.dimension_value(
+                        logits.get_shape()[2])]),
+                    tf.reshape(targets, [-1]))
+                crossent = tf.reshape(crossent, tf.shape(input=targets))
+            target_weights = tf.stack(target_weights)
+            log_perps = tf.reduce_sum(
+                input_tensor=crossent * target_weights, axis=0)
+            total_size = tf.reduce_sum(input_tensor=target_weights, axis=0)
             log_perps /= total_size
 
         avg_log_perps = tf.reduce_mean(input_tensor=log_perps)
@@ -413,24 +451,35 @@ class EncoderDecoderModel(graph_utils.NNModel):
             channel 0 - seq2seq decoder inputs
             channel 1 - copynet decoder targets
         """
-        def load_channel(inputs, output_length, reversed_output=True):
+        def load_channel(inputs, output_length, reversed_output=True,
+                         channel=None):
             """
             Convert a batch of feature vectors into a batched feature vector.
             """
-            padded_inputs = []
-            batch_inputs = []
-            for batch_idx in xrange(batch_size):
-                input = inputs[batch_idx]
-                paddings = [data_utils.PAD_ID] * (output_length - len(input))
-                if reversed_output:
-                    padded_inputs.append(list(reversed(input + paddings)))
-                else:
-                    padded_inputs.append(input + paddings)
-            for length_idx in xrange(output_length):
-                batched_dim = np.array([padded_inputs[batch_idx][length_idx]
-                        for batch_idx in xrange(batch_size)], dtype=np.int32)
-                batch_inputs.append(batched_dim)
-            return batch_inputs
+            # Scatter all tokens of the batch into the padded time-major
+            # buffer at once
+            lengths = np.fromiter(map(len, inputs), dtype=np.intp,
+                                  count=batch_size)
+            tokens = np.fromiter(itertools.chain.from_iterable(inputs),
+                                 dtype=np.int32, count=lengths.sum())
+            batch_idx = np.repeat(np.arange(batch_size), lengths)
+            # position of each token in its input sequence
+            token_idx = np.arange(len(tokens)) - \
+                np.repeat(np.cumsum(lengths) - lengths, lengths)
+            if reversed_output:
+                # reversed(input + paddings), truncated to output_length
+                length_idx = np.repeat(
+                    np.maximum(lengths, output_length) - 1, lengths) - token_idx
+            else:
+                length_idx = token_idx
+            in_range = length_idx < output_length
+            padded_inputs = self.get_feed_buffer(
+                (channel, bucket_id), (output_length, batch_size))
+            padded_inputs.fill(data_utils.PAD_ID)
+            padded_inputs[length_idx[in_range], batch_idx[in_range]] = \
+                tokens[in_range]
+            # [output_length, batch_size]
+            return padded_inputs
 
         if bucket_id != -1:
             encoder_size, decoder_size = self.buckets[bucket_id]
@@ -441,49 +490,62 @@ class EncoderDecoderModel(graph_utils.NNModel):
 
         # create batch-major vectors
         batch_encoder_inputs = load_channel(
-            encoder_input_channels[0], encoder_size, reversed_output=True)
+            encoder_input_channels[0], encoder_size, reversed_output=True,
+            channel='encoder_inputs')
         batch_decoder_inputs = load_channel(
-            decoder_input_channels[0], decoder_size, reversed_output=False)
+            decoder_input_channels[0], decoder_size, reversed_output=False,
+            channel='decoder_inputs')
         if self.copynet:
             batch_encoder_copy_inputs = load_channel(
-                encoder_input_channels[1], encoder_size, reversed_output=True)
+                encoder_input_channels[1], encoder_size, reversed_output=True,
+                channel='encoder_copy_inputs')
             batch_copy_targets = load_channel(
-                decoder_input_channels[1], decoder_size, reversed_output=False)
-
-        batch_encoder_input_masks = []
-        batch_decoder_input_masks = []
-        for length_idx in xrange(encoder_size):
-            batch_encoder_input_mask = np.ones(batch_size, dtype=np.float32)
-            for batch_idx in xrange(batch_size):
-                source = batch_encoder_inputs[length_idx][batch_idx]
-                if source == data_utils.PAD_ID:
-                    batch_encoder_input_mask[batch_idx] = 0.0
-            batch_encoder_input_masks.append(batch_encoder_input_mask)
-
-        for length_idx in xrange(decoder_size):
-            # Create target_weights to be 0 for targets that are padding.
-            batch_decoder_input_mask = np.ones(batch_size, dtype=np.float32)
-            for batch_idx in xrange(batch_size):
-                # We set weight to 0 if the corresponding target is a PAD symbol.
-                # The corresponding target is decoder_input shifted by 1 forward.
-                if length_idx < decoder_size - 1:
-                    target = batch_decoder_inputs[length_idx+1][batch_idx]
-                if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
-                    batch_decoder_input_mask[batch_idx] = 0.0
-            batch_decoder_input_masks.append(batch_decoder_input_mask)
+                decoder_input_channels[1], decoder_size, reversed_output=False,
+                channel='copy_targets')
+
+        batch_encoder_input_masks = self.get_feed_buffer(
+            ('encoder_attn_masks', bucket_id), (encoder_size, batch_size),
+            dtype=np.float32)
+        np.not_equal(batch_encoder_inputs, data_utils.PAD_ID,
+                     out=batch_encoder_input_masks, casting='unsafe')
+
+        # Create target_weights to be 0 for targets that are padding.
+        # The corresponding target is decoder_input shifted by 1 forward, and
+        # the last decoder input has no target.
+        batch_decoder_input_masks = self.get_feed_buffer(
+            ('target_weights', bucket_id), (decoder_size, batch_size),
+            dtype=np.float32)
+        np.not_equal(batch_decoder_inputs[1:], data_utils.PAD_ID,
+                     out=batch_decoder_input_masks[:-1], casting='unsafe')
+        batch_decoder_input_masks[-1] = 0.0
 
         E = Example()
-        E.encoder_inputs = batch_encoder_inputs
-        E.encoder_attn_masks = batch_encoder_input_masks
-        E.decoder_inputs = batch_decoder_inputs
-        E.target_weights = batch_decoder_input_masks
+        E.encoder_inputs = list(batch_encoder_inputs)
+        E.encoder_attn_masks = list(batch_encoder_input_masks)
+        E.decoder_inputs = list(batch_decoder_inputs)
+        E.target_weights = list(batch_decoder_input_masks)
         if self.use_copy:
-            E.encoder_copy_inputs = batch_encoder_copy_inputs
-            E.copy_targets = batch_copy_targets
+            E.encoder_copy_inputs = list(batch_encoder_copy_inputs)
+            E.copy_targets = list(batch_copy_targets)
 
         return E
 
 
+    def get_feed_buffer(self, key, shape, dtype=np.int32):
+        """
+        Return a numpy array of the given shape that is reused across batches.
+
+        The buffers are overwritten by the next call with the same key, so the
+        formatted batches must be fed to the network before the next batch of
+        the same bucket is formatted.
+        """
+        buffer = self.feed_buffers.get(key)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.feed_buffers[key] = buffer
+        return buffer
+
+
     def get_batch(self, data, bucket_id=-1, use_all=False):
         """
         Randomly sample a batch of examples from the specified bucket and
@@ -500,9 +562,10 @@ class EncoderDecoderModel(graph_utils.NNModel):
             sample_pool = data[bucket_id]
 
         # Randomly sample a batch of encoder and decoder inputs from data
-        data_ids = list(xrange(len(sample_pool)))
-        if not use_all:
-            data_ids = np.random.choice(data_ids, self.batch_size)
+        if use_all:
+            data_ids = xrange(len(sample_pool))
+        else:
+            data_ids = np.random.randint(len(sample_pool), size=self.batch_size)
         for i in data_ids:
             data_point = sample_pool[i]
             encoder_inputs.append(data_point.sc_ids)
@@ -603,25 +666,33 @@ class EncoderDecoderModel(graph_utils.NNModel):
                     'sequence_logits': self.sequence_logits[bucket_id],   # Batch output sequence
                     'losses': self.losses[bucket_id]}           # Batch output logits
 
-        if self.tg_token_use_attention:
-            if bucket_id == -1:
-                output_feed['attn_alignments'] = self.attn_alignments
+        # The attention masks, hidden states and copy pointers are only used
+        # after forward steps (decoding, slot filling), so training steps do
+        # not fetch them
+        if forward_only:
+            if self.tg_token_use_attention:
+                if bucket_id == -1:
+                    output_feed['attn_alignments'] = self.attn_alignments
+                else:
+                    output_feed['attn_alignments'] = \
+                        self.attn_alignments[bucket_id]
+
+            if bucket_id != -1:
+                assert(isinstance(self.encoder_hidden_states, list))
+                assert(isinstance(self.decoder_hidden_states, list))
+                output_feed['encoder_hidden_states'] = \
+                    self.encoder_hidden_states[bucket_id]
+                output_feed['decoder_hidden_states'] = \
+                    self.decoder_hidden_states[bucket_id]
             else:
-                output_feed['attn_alignments'] = self.attn_alignments[bucket_id]
+                output_feed['encoder_hidden_states'] = self.encoder_hidden_states
+                output_feed['decoder_hidden_states'] = self.decoder_hidden_states
 
-        if bucket_id != -1:
-            assert(isinstance(self.encoder_hidden_states, list))
-            assert(isinstance(self.decoder_hidden_states, list))
-            output_feed['encoder_hidden_states'] = \
-                self.encoder_hidden_states[bucket_id]
-            output_feed['decoder_hidden_states'] = \
-                self.decoder_hidden_states[bucket_id]
-        else:
-            output_feed['encoder_hidden_states'] = self.encoder_hidden_states
-            output_feed['decoder_hidden_states'] = self.decoder_hidden_states
-
-        if self.use_copy:
-            output_feed['pointers'] = self.pointers
+            if self.use_copy:
+                if bucket_id == -1:
+                    output_feed['pointers'] = self.pointers
+                else:
+                    output_feed['pointers'] = self.pointers[bucket_id]
 
         extra_update_ops = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.UPDATE_OPS)
         if extra_update_ops and not forward_only:
@@ -640,15 +711,15 @@ class EncoderDecoderModel(graph_utils.NNModel):
             O.output_symbols = outputs['output_symbols']
             O.sequence_logits = outputs['sequence_logits']
             O.losses = outputs['losses']
-        # [attention_masks]
-        if self.tg_token_use_attention:
-            O.attn_alignments = outputs['attn_alignments']
+            # [attention_masks]
+            if self.tg_token_use_attention:
+                O.attn_alignments = outputs['attn_alignments']
 
-        O.encoder_hidden_states = outputs['encoder_hidden_states']
-        O.decoder_hidden_states = outputs['decoder_hidden_states']
+            O.encoder_hidden_states = outputs['encoder_hidden_states']
+            O.decoder_hidden_states = outputs['decoder_hidden_states']
 
-        if self.use_copy:
-            O.pointers = outputs['pointers']
+            if self.use_copy:
+                O.pointers = outputs['pointers']
 
         return O
 
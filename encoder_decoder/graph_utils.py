@@ -11,6 +11,10 @@ import tensorflow as tf
 from tensorflow.python.util import nest
 
 
+# Variables created by the dynamic loss scale of MixedPrecisionLossScaleOptimizer
+LOSS_SCALE_VARIABLE_NAMES = ('current_loss_scale', 'good_steps')
+
+
 def define_model(FLAGS, session, model_constructor, buckets, forward_only):
     params = collections.defaultdict()
 
@@ -72,6 +76,7 @@ def define_model(FLAGS, session, model_constructor, buckets, forward_only):
     params["learning_rate"] = FLAGS.learning_rate
     params["learning_rate_decay_factor"] = FLAGS.learning_rate_decay_factor
     params["adam_epsilon"] = FLAGS.adam_epsilon
+    params["mixed_precision"] = FLAGS.mixed_precision
 
     params["steps_per_epoch"] = FLAGS.steps_per_epoch
     params["num_epochs"] = FLAGS.num_epochs
@@ -116,8 +121,8 @@ def define_model(FLAGS, session, model_constructor, buckets, forward_only):
     print("decode_sig={}".format(decode_sig))
 
     if forward_only:
-        # Set batch_size to 1 for decoding.
-        params["batch_size"] = 1
+        # Set batch_size for decoding.
+        params["batch_size"] = FLAGS.decode_batch_size
         # Reset dropout probabilities for decoding.
         params["attention_input_keep"] = 1.0
         params["attention_output_keep"] = 1.0
@@ -145,7 +150,7 @@ def define_model(FLAGS, session, model_constructor, buckets, forward_only):
         ckpt = tf.train.get_checkpoint_state(
             os.path.join(FLAGS.model_root_dir, FLAGS.model_dir))
         print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+        restore_parameters(session, model, ckpt.model_checkpoint_path)
     else:
         if not os.path.exists(FLAGS.model_dir):
             print("Making model_dir...")
@@ -159,7 +164,8 @@ def define_model(FLAGS, session, model_constructor, buckets, forward_only):
             print("Initialize the graph with pre-trained parameters from {}"
                   .format(pretrain_dir))
             pretrain_ckpt = tf.train.get_checkpoint_state(pretrain_dir)
-            model.saver.restore(session, pretrain_ckpt.model_checkpoint_path)
+            restore_parameters(
+                session, model, pretrain_ckpt.model_checkpoint_path)
             session.run(model.learning_rate.assign(
                 tf.constant(FLAGS.learning_rate)))
         else:
@@ -169,6 +175,30 @@ def define_model(FLAGS, session, model_constructor, buckets, forward_only):
     return model
 
 
+def restore_parameters(session, model, checkpoint_path):
+    """
+    Restore model parameters from a checkpoint. When training with
+    --mixed_precision, the dynamic loss scale variables may be missing from a
+    checkpoint trained without it and are initialized instead; any other
+    missing variable fails the restore.
+    """
+    if model.mixed_precision and not model.forward_only:
+        saved_variables = set(
+            name for name, _ in tf.train.list_variables(checkpoint_path))
+        loss_scale_variables, restored = [], []
+        for v in tf.compat.v1.global_variables():
+            if v.op.name not in saved_variables and \
+                    v.op.name.split('/')[-1] in LOSS_SCALE_VARIABLE_NAMES:
+                loss_scale_variables.append(v)
+            else:
+                restored.append(v)
+        if loss_scale_variables:
+            session.run(tf.compat.v1.variables_initializer(loss_scale_variables))
+            tf.compat.v1.train.Saver(restored).restore(session, checkpoint_path)
+            return
+    model.saver.restore(session, checkpoint_path)
+
+
 def get_decode_signature(FLAGS):
     """
     Model signature is used to locate the trained parameters and
@@ -234,15 +264,15 @@ def get_decode_signature(FLAGS):
 
 
 def clean_dir(dir):
-    for f_name in os.listdir(dir):
-        if f_name.startswith('prediction'):
-            continue
-        f_path = os.path.join(dir, f_name)
-        try:
-            if os.path.isfile(f_path):
-                os.unlink(f_path)
-        except Exception as e:
-            print(e)
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('prediction'):
+                continue
+            try:
+                if entry.is_file():
+                    os.unlink(entry.path)
+            except OSError as e:
+                print(e)
 
 
 def softmax_loss(output_project, num_samples, target_vocab_size):
@@ -662,6 +692,8 @@ class NNModel(object):
     def __init__(self, hyperparams, buckets=None):
         self.hyperparams = hyperparams
         self.buckets = buckets
+        # bucket source sizes, sorted in ascending order
+        self.bucket_sc_sizes = [b[0] for b in buckets] if buckets else None
 
     # --- model architecture hyperparameters --- #
 
@@ -720,6 +752,10 @@ class NNModel(object):
     def adam_epsilon(self):
         return self.hyperparams["adam_epsilon"]
 
+    @property
+    def mixed_precision(self):
+        return self.hyperparams["mixed_precision"]
+
     @property
     def tg_token_use_attention(self):
         return self.hyperparams["tg_token_use_attention"]
@@ -68,6 +68,11 @@ def define_input_flags():
     # device
     tf.compat.v1.flags.DEFINE_string('gpu', '0', 'GPU device where the computation is going to be placed.')
     tf.compat.v1.flags.DEFINE_boolean('log_device_placement', False, 'Set to True for logging device placement.')
+    tf.compat.v1.flags.DEFINE_boolean('xla_jit', False, 'Set to True to compile the computation graph with XLA JIT.')
+    tf.compat.v1.flags.DEFINE_integer('intra_op_parallelism_threads', 0,
+                                'Number of threads used within an op (e.g. a matmul); 0 lets TensorFlow decide.')
+    tf.compat.v1.flags.DEFINE_integer('inter_op_parallelism_threads', 0,
+                                'Number of independent ops run in parallel; 0 lets TensorFlow decide.')
 
     # data hyperparameters
     tf.compat.v1.flags.DEFINE_string('dataset', 'bash', 'select dataset to use.')
@@ -100,6 +105,9 @@ def define_input_flags():
     tf.compat.v1.flags.DEFINE_float('learning_rate_decay_factor', 0.99,
                               'Learning rate decays by this much.')
     tf.compat.v1.flags.DEFINE_float('adam_epsilon', 1e-08, 'Epsilon parameter in the Adam Optimizer.')
+    tf.compat.v1.flags.DEFINE_boolean('mixed_precision', False,
+                                'Set to True to run matmuls in float16 with dynamic loss scaling '
+                                '(float32 master weights).')
     tf.compat.v1.flags.DEFINE_float('max_gradient_norm', 5.0,
                               'Clip gradients to this norm.')
     tf.compat.v1.flags.DEFINE_integer('batch_size', 128,
@@ -154,6 +162,8 @@ def define_input_flags():
     tf.compat.v1.flags.DEFINE_string('char_decoding_algorithm', 'greedy',
                                'decoding algorithm used for character generation.')
     tf.compat.v1.flags.DEFINE_integer('beam_size', -1, 'Size of beam for beam search.')
+    tf.compat.v1.flags.DEFINE_integer('decode_batch_size', 1,
+                                'Number of dev/test examples decoded in one model step.')
     tf.compat.v1.flags.DEFINE_integer('beam_order', -1, 'Order for beam search.')
     tf.compat.v1.flags.DEFINE_float('alpha', 0.5, 'Beam search length normalization parameter.')
     tf.compat.v1.flags.DEFINE_integer('top_k', 5, 'Top-k highest-scoring structures to output.')
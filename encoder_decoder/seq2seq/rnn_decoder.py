@@ -127,6 +127,14 @@ class RNNDecoder(decoder.Decoder):
                 past_output_logits.append(output_logits)
                 return output_symbol, output_logits
 
+            if self.copynet:
+                # Shapes and copy inputs used by the selective reads, which
+                # are the same in every decoding step
+                attn_length = attention_states.get_shape()[1]
+                attn_dim = attention_states.get_shape()[2]
+                encoder_copy_inputs_2d = tf.concat(
+                    [tf.expand_dims(x, 1) for x in encoder_copy_inputs], axis=1)
+
             for i, input in enumerate(decoder_inputs):
                 if bs_decoding:
                     input = beam_decoder.wrap_input(input)
@@ -156,16 +164,12 @@ class RNNDecoder(decoder.Decoder):
 
                 # Appending selective read information for CopyNet
                 if self.copynet:
-                    attn_length = attention_states.get_shape()[1]
-                    attn_dim = attention_states.get_shape()[2]
                     if i == 0:
                         # Append dummy zero vector to the <START> token
                         selective_reads = tf.zeros([self.batch_size, attn_dim])
                         if bs_decoding:
                             selective_reads = beam_decoder.wrap_input(selective_reads)
                     else:
-                        encoder_copy_inputs_2d = tf.concat(
-                            [tf.expand_dims(x, 1) for x in encoder_copy_inputs], axis=1)
                         if self.forward_only:
                             copy_input = tf.compat.v1.where(decoder_input >= self.target_vocab_size,
                                                   tf.reduce_sum(
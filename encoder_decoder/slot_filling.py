@@ -12,9 +12,8 @@ if sys.version_info > (3, 0):
 
 import collections, copy, re
 import numpy as np
-from numpy.linalg import norm
 
-from bashlint import bash, data_tools
+from bashlint import bash, data_tools, lint
 from nlp_tools import constants, format_args, tokenizer
 
 
@@ -30,20 +29,50 @@ class KNearestNeighborModel():
         self.k = k
         self.train_X = train_X
         self.train_Y = train_Y
+        # only the positive label column is used for prediction
+        self.train_y = train_Y[:, 0]
 
     def predict(self, X):
         """
         :param X: [size, dim]
         """
-        # [size, size]
+        # [size, train_size]
         sim_scores = np.matmul(X, self.train_X.T)
+        return self.predict_from_scores(sim_scores)
+
+    def predict_pairs(self, X1, X2):
+        """
+        Predict on the L2-normalized concatenation of every row of X1 with
+        every row of X2. Each side is multiplied with its half of the training
+        matrix only once, instead of once per pair.
+
+        :param X1: [size1, dim1]
+        :param X2: [size2, dim - dim1]
+        :return: [size1 * size2] predictions, ordered by (X1 row, X2 row)
+        """
+        dim1 = X1.shape[1]
+        # [size1, train_size], [size2, train_size]
+        sim_scores1 = np.matmul(X1, self.train_X[:, :dim1].T)
+        sim_scores2 = np.matmul(X2, self.train_X[:, dim1:].T)
+        # [size1, size2]
+        norms = np.sqrt(np.sum(X1 * X1, axis=1)[:, None] +
+                        np.sum(X2 * X2, axis=1)[None, :])
+        # [size1, size2, train_size]
+        sim_scores = (sim_scores1[:, None, :] + sim_scores2[None, :, :]) / \
+                     norms[:, :, None]
+        return self.predict_from_scores(
+            sim_scores.reshape([-1, sim_scores.shape[2]]))
+
+    def predict_from_scores(self, sim_scores):
+        """
+        :param sim_scores: [size, train_size]
+        """
         # [size, self.k]
         nn = np.argpartition(sim_scores, -self.k, axis=1)[:, -self.k:]
         # [size, self.k]
-        nn_weights = np.partition(sim_scores, -self.k, axis=1)[:, -self.k:]
+        nn_weights = np.take_along_axis(sim_scores, nn, axis=1)
 
-        nn_prediction = np.sum(
-            np.expand_dims(nn_weights, 2) * self.train_Y[nn], axis=1)[:, 0]
+        nn_prediction = np.sum(nn_weights * self.train_y[nn], axis=1)
         return nn_prediction
 
     def eval(self, X, Y, verbose=True):
@@ -67,6 +96,7 @@ def gen_slot_filling_training_data(sess, FLAGS, model, dataset, output_file):
     print("saving slot filling mappings to {}".format(output_file))
 
     X, Y = [], []
+    num_examples = 0
     for bucket_id in xrange(len(model.buckets)):
         for i in xrange(len(dataset.data_points[bucket_id])):
             dp = dataset.data_points[bucket_id][i]
@@ -88,33 +118,36 @@ def gen_slot_filling_training_data(sess, FLAGS, model, dataset, output_file):
                     sess, formatted_example, bucket_id, forward_only=True)
                 encoder_outputs = model_outputs.encoder_hidden_states
                 decoder_outputs = model_outputs.decoder_hidden_states
-                # add positive examples
+                # collect the (encoder step, decoder step) index pairs of the
+                # examples and gather their hidden states in one go
+                encoder_inds, decoder_inds, labels = [], [], []
                 for f, s in mappings:
                     # use reversed index for the encoder embedding matrix
                     ff = model.buckets[bucket_id][0] - f - 1
                     if f >= encoder_outputs.shape[1] or s >= decoder_outputs.shape[1]:
                         continue
-                    X.append(np.concatenate([encoder_outputs[:, ff, :],
-                                             decoder_outputs[:, s, :]], axis=1))
-                    Y.append(np.array([[1, 0]]))
+                    # add positive examples
+                    encoder_inds.append(ff)
+                    decoder_inds.append(s)
+                    labels.append([1, 0])
                     # add negative examples
                     # sample unmatched filler-slot pairs as negative examples
                     if len(mappings) > 1:
                         for n_s in [ss for _, ss in mappings if ss != s]:
                             if n_s >= decoder_outputs.shape[1]:
                                 continue
-                            X.append(np.concatenate(
-                                [encoder_outputs[:, ff, :],
-                                 decoder_outputs[:, n_s, :]], axis=1))
-                            Y.append(np.array([[0, 1]]))
-                    # Debugging
-                    # if i == 0:
-                    #     print(ff)
-                    #     print(encoder_outputs[0])
-                    #     print(decoder_outputs[0])
-                    if len(X) > 0 and len(X) % 1000 == 0:
+                            encoder_inds.append(ff)
+                            decoder_inds.append(n_s)
+                            labels.append([0, 1])
+                if encoder_inds:
+                    X.append(np.concatenate(
+                        [encoder_outputs[0, encoder_inds, :],
+                         decoder_outputs[0, decoder_inds, :]], axis=1))
+                    Y.append(np.array(labels))
+                    num_examples += len(labels)
+                    if num_examples // 1000 > (num_examples - len(labels)) // 1000:
                         print('{} examples gathered for generating slot filling '
-                              'features...'.format(len(X)))
+                              'features...'.format(num_examples))
 
     assert(len(X) == len(Y))
     X = np.concatenate(X, axis=0)
@@ -172,24 +205,22 @@ def stable_slot_filling(template_tokens, sc_fillers, tg_slots, pointer_targets,
         assert(decoder_outputs is not None)
         assert(slot_filling_classifier is not None)
         pointer_targets = np.zeros([len(encoder_outputs), len(decoder_outputs)])
-        for f in xrange(M.shape[0]):
-            if np.sum(M[f]) > 1:
-                X = []
-                # use reversed index for the encoder embeddings matrix
-                ff = len(encoder_outputs) - f - 1
-                cm_slots_keys = list(tg_slots.keys())
-                for s in cm_slots_keys:
-                    X.append(np.concatenate([encoder_outputs[ff:ff+1],
-                                             decoder_outputs[s:s+1]], axis=1))
-                X = np.concatenate(X, axis=0)
-                X = X / norm(X, axis=1)[:, None]
-                raw_scores = slot_filling_classifier.predict(X)
-                for ii in xrange(len(raw_scores)):
-                    s = cm_slots_keys[ii]
-                    pointer_targets[f, s] = raw_scores[ii]
-                    if verbose:
+        # fillers that can be matched to more than one slot
+        fillers = [f for f in xrange(M.shape[0]) if np.sum(M[f]) > 1]
+        if fillers:
+            cm_slots_keys = list(tg_slots.keys())
+            # use reversed index for the encoder embeddings matrix
+            ffs = [len(encoder_outputs) - f - 1 for f in fillers]
+            # score all (filler, slot) pairs with a single classifier call
+            raw_scores = slot_filling_classifier.predict_pairs(
+                encoder_outputs[ffs], decoder_outputs[cm_slots_keys]).reshape(
+                [len(fillers), len(cm_slots_keys)])
+            pointer_targets[np.ix_(fillers, cm_slots_keys)] = raw_scores
+            if verbose:
+                for i, f in enumerate(fillers):
+                    for ii, s in enumerate(cm_slots_keys):
                         print('• alignment ({}, {}): {}\t{}\t{}'.format(
-                            f, s, sc_fillers[f], tg_slots[s], raw_scores[ii]))
+                            f, s, sc_fillers[f], tg_slots[s], raw_scores[i, ii]))
 
     M = M + M * pointer_targets
     # convert M into a dictinary representation of a sparse matrix
@@ -372,8 +403,10 @@ def slot_filler_alignment_induction(nl, cm, verbose=False):
     # and the slots in the command
     tokens, entities = tokenizer.ner_tokenizer(nl)
     nl_fillers, _, _ = entities
-    cm_tokens = data_tools.bash_tokenizer(cm)
-    cm_tokens_with_types = data_tools.bash_tokenizer(cm, arg_type_only=True)
+    # parse once and tokenize the same tree with and without argument types
+    cm_ast = lint.normalize_ast(cm)
+    cm_tokens = data_tools.bash_tokenizer(cm_ast)
+    cm_tokens_with_types = data_tools.bash_tokenizer(cm_ast, arg_type_only=True)
     assert(len(cm_tokens) == len(cm_tokens_with_types))
     cm_slots = {}
     for i in xrange(len(cm_tokens_with_types)):
@@ -24,6 +24,7 @@ import time
 from tqdm import tqdm
 
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 
 from encoder_decoder import data_utils
 from encoder_decoder import decode_tools
@@ -41,6 +42,29 @@ parse_args.define_input_flags()
 
 # --- Define models --- #
 
+def session_config(training=False):
+    """
+    Session configuration shared by all experiments.
+    :param training: set to True for the training session; --mixed_precision
+        only applies to training.
+    """
+    config = tf.compat.v1.ConfigProto(allow_soft_placement=True,
+        log_device_placement=FLAGS.log_device_placement,
+        intra_op_parallelism_threads=FLAGS.intra_op_parallelism_threads,
+        inter_op_parallelism_threads=FLAGS.inter_op_parallelism_threads)
+    if FLAGS.xla_jit:
+        # Let XLA cluster and fuse the elementwise op chains of the unrolled
+        # encoder-decoder graph (e.g. the attention read in every decoder step)
+        config.graph_options.optimizer_options.global_jit_level = \
+            tf.compat.v1.OptimizerOptions.ON_1
+    if training and FLAGS.mixed_precision:
+        # Must be set on the session config: the graph is built after the
+        # session is created, so the global graph rewrite switch comes too late
+        config.graph_options.rewrite_options.auto_mixed_precision = \
+            rewriter_config_pb2.RewriterConfig.ON
+    return config
+
+
 def define_model(session, forward_only, buckets=None):
     """
     Define tensor graphs.
@@ -58,8 +82,7 @@ def define_model(session, forward_only, buckets=None):
 # --- Run experiments --- #
 
 def train(train_set, test_set, verbose=False):
-    with tf.compat.v1.Session(config=tf.compat.v1.ConfigProto(allow_soft_placement=True,
-            log_device_placement=FLAGS.log_device_placement)) as sess:
+    with tf.compat.v1.Session(config=session_config(training=True)) as sess:
         # Initialize model parameters
         model = define_model(sess, forward_only=False, buckets=train_set.buckets)
 
@@ -158,8 +181,7 @@ def train(train_set, test_set, verbose=False):
 
 
 def decode(dataset, buckets=None, verbose=True):
-    with tf.compat.v1.Session(config=tf.compat.v1.ConfigProto(allow_soft_placement=True,
-            log_device_placement=FLAGS.log_device_placement)) as sess:
+    with tf.compat.v1.Session(config=session_config()) as sess:
         # Initialize model parameters.
         model = define_model(sess, forward_only=True, buckets=buckets)
         decode_tools.decode_set(sess, model, dataset, 3, FLAGS, verbose)
@@ -187,8 +209,7 @@ def manual_eval(dataset, prediction_path=None):
 
 
 def demo(buckets=None):
-    with tf.compat.v1.Session(config=tf.compat.v1.ConfigProto(allow_soft_placement=True,
-        log_device_placement=FLAGS.log_device_placement)) as sess:
+    with tf.compat.v1.Session(config=session_config()) as sess:
         # Initialize model parameters.
         model = define_model(sess, forward_only=True, buckets=buckets)
         decode_tools.demo(sess, model, FLAGS)
@@ -200,8 +221,7 @@ def gen_slot_filling_training_data(FLAGS, datasets):
     FLAGS.token_decoding_algorithm = 'greedy'
     FLAGS.force_reading_input = True
 
-    with tf.compat.v1.Session(config=tf.compat.v1.ConfigProto(allow_soft_placement=True,
-            log_device_placement=FLAGS.log_device_placement)) as sess:
+    with tf.compat.v1.Session(config=session_config()) as sess:
         # Create model and load parameters.
         train_set, dev_set, test_set = datasets
         model = define_model(sess, forward_only=True, buckets=train_set.buckets)
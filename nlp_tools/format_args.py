@@ -15,6 +15,8 @@ import datetime, re
 from bashlint import bash
 from nlp_tools import constants
 
+_DIGIT_RE = re.compile(constants._DIGIT_RE)
+
 
 # --- Slot filling value extractors --- #
 
@@ -83,8 +85,7 @@ def extract_value(filler_type, slot_type, surface):
     return value
 
 def extract_number(value):
-    digit_re = re.compile(constants._DIGIT_RE)
-    match = re.search(digit_re, value)
+    match = _DIGIT_RE.search(value)
     if match:
         return match.group(0)
     else: